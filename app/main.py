@@ -1,17 +1,54 @@
-from fastapi import FastAPI, Query, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import Body, FastAPI, Query, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import qrcode
+from pydantic import BaseModel, Field
+from contextlib import asynccontextmanager
+import anyio
+import base64
 import io
-import re
-from datetime import datetime
-import json
-from typing import Optional
-import uuid
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from typing import Literal, Optional
+from urllib.parse import quote
+
+import barcode
+import barcode.writer
+import segno
+from barcode.writer import ImageWriter, SVGWriter
+import PIL
+from PIL import ImageFont
+
+from app.render import (
+    ERROR_MAP,
+    RENDERERS,
+    InvalidColorError,
+    build_qr_png,
+    generate_vehicle_qr_data,
+    make_qr_code,
+    sanitize_filename,
+    utc_timestamp,
+)
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # QR rendering runs in the threadpool; allow more concurrent renders than the default 40
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 64
+    # pillow-simd versions carry a .postN suffix; warn if stock Pillow was installed instead
+    if ".post" in PIL.__version__:
+        logger.info("Using pillow-simd %s", PIL.__version__)
+    else:
+        logger.warning("Using stock Pillow %s, not pillow-simd", PIL.__version__)
+    yield
 
 app = FastAPI(
     title="QR Code Generator API",
-    description="API for generating QR code images from text input with enhanced vehicle data support",
+    description="API for generating QR code and barcode images from text input with enhanced vehicle data support",
     version="2.0.0",
     contact={
         "name": "Ked",
@@ -21,9 +58,38 @@ app = FastAPI(
         "name": "MIT License",
     },
     docs_url=None,
-    redoc_url="/"
+    redoc_url="/",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
+class InternalErrorMiddleware:
+    """Turn unhandled errors into a JSON 500 inside CORSMiddleware so cross-origin clients can read it."""
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            if started:
+                # Too late for a 500; let ServerErrorMiddleware/uvicorn log and close it
+                raise
+            logger.exception("Unhandled error on %s %s", scope["method"], scope["path"])
+            await ORJSONResponse({"detail": "internal error"}, status_code=500)(scope, receive, send)
+
+# Added before CORS so it runs inside it and its 500s carry Access-Control-Allow-Origin
+app.add_middleware(InternalErrorMiddleware)
+
 # Enable CORS
 app.add_middleware(
     CORSMiddleware,
@@ -31,56 +97,104 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-QR-Data", "X-Generated-At", "Content-Disposition"],
 )
 
-def sanitize_filename(filename: str) -> str:
-    """Sanitize the filename by removing special characters and limiting length."""
-    filename = re.sub(r'[\\/*?:"<>|]', "_", filename)
-    return filename[:100]
-
-def validate_vehicle_data(data: dict) -> bool:
-    """Validate required vehicle data fields."""
-    required_fields = [
-        'brandid', 'vehiclename', 'modelnumber', 'regnumber',
-        'vehicletype', 'vehiclesubtype', 'varient', 'transmission',
-        'chasisnum', 'enginenumber'
-    ]
-    return all(field in data and data[field] for field in required_fields)
-
-def generate_vehicle_qr_data(data: dict) -> str:
-    """Generate structured QR data from vehicle information."""
-    qr_data = {
-        "id": str(uuid.uuid4()),
-        "timestamp": datetime.utcnow().isoformat(),
-        "vehicle": {
-            "brand": data.get('brandid', ''),
-            "name": data.get('vehiclename', ''),
-            "model": data.get('modelnumber', ''),
-            "reg": data.get('regnumber', ''),
-            "type": data.get('vehicletype', ''),
-            "subtype": data.get('vehiclesubtype', ''),
-            "variant": data.get('varient', ''),
-            "transmission": data.get('transmission', ''),
-            "chassis": data.get('chasisnum', ''),
-            "engine": data.get('enginenumber', ''),
-            "description": data.get('description', '')
-        },
-        "system": {
-            "generated_by": "QR Code API",
-            "version": "2.0"
-        }
-    }
-    return json.dumps(qr_data)
+@app.exception_handler(segno.DataOverflowError)
+async def qr_overflow_handler(request: Request, exc: segno.DataOverflowError):
+    return ORJSONResponse(
+        {"detail": f"Data too large for a QR code at the requested error correction level: {exc}"},
+        status_code=413
+    )
+
+@app.exception_handler(barcode.errors.BarcodeError)
+async def barcode_error_handler(request: Request, exc: barcode.errors.BarcodeError):
+    return ORJSONResponse({"detail": f"Invalid barcode data: {exc}"}, status_code=400)
+
+@app.exception_handler(InvalidColorError)
+async def invalid_color_handler(request: Request, exc: InvalidColorError):
+    return ORJSONResponse({"detail": f"Invalid color: {exc}"}, status_code=400)
+
+# Media types of the output formats accepted by /qrcode and /barcode
+MEDIA_TYPES = {
+    "png": "image/png",
+    "svg": "image/svg+xml"
+}
+
+# Largest percent-encoded payload sent in X-QR-Data; fits common 4-8 KB proxy header buffers
+MAX_QR_DATA_HEADER = 4096
+
+# A version 40 QR code at level L holds at most 7089 numeric characters (2953 bytes of
+# arbitrary text), so longer input can never be encoded
+MAX_QR_DATA = 7089
+
+# Longest ID accepted by /barcode; GS1-128 caps labels at 48 data characters, and render
+# time and PNG size grow linearly with length (about 20 ms and 12 KB at this limit)
+MAX_BARCODE_DATA = 80
+
+CODE128 = barcode.get_barcode_class("code128")
+
+def render_cache(max_bytes: int = 32 * 1024 * 1024, max_entry_bytes: int = 64 * 1024):
+    """
+    LRU cache for renderers returning (bytes, ETag), bounded by total content size.
+    
+    lru_cache(maxsize=...) only bounds the entry count, and one high-version PNG can be
+    hundreds of KB, so outputs over max_entry_bytes are returned without being stored.
+    """
+    def decorator(func):
+        entries = OrderedDict()
+        lock = threading.Lock()
+        stored = 0
+        
+        @wraps(func)
+        def wrapper(*args):
+            nonlocal stored
+            with lock:
+                if args in entries:
+                    entries.move_to_end(args)
+                    return entries[args]
+            result = func(*args)
+            size = len(result[0])
+            if size > max_entry_bytes:
+                return result
+            with lock:
+                if args not in entries:
+                    entries[args] = result
+                    stored += size
+                    while stored > max_bytes:
+                        _, (evicted, _) = entries.popitem(last=False)
+                        stored -= len(evicted)
+            return result
+        return wrapper
+    return decorator
+
+class _CachedImageFont:
+    """Stand-in for PIL.ImageFont in barcode.writer that reads each font size from disk once."""
+    truetype = staticmethod(lru_cache(maxsize=None)(ImageFont.truetype))
+
+# ImageWriter._paint_text calls ImageFont.truetype(font_path, size) from barcode.writer on
+# every render; only that load is cached, the writer still does its own text layout
+barcode.writer.ImageFont = _CachedImageFont
+
+@render_cache()
+def _render_qr(data: str, size: int, border: int, fill_color: str, back_color: str,
+               version: int, error_correction: str, fmt: str) -> tuple:
+    """Build and render a QR code in fmt, returning (bytes, ETag) for repeated /qrcode requests."""
+    qr = make_qr_code(data, version, error_correction)
+    content = RENDERERS[fmt](qr, size, border, fill_color, back_color)
+    return content, f'"{hashlib.sha1(content).hexdigest()}"'
 
 @app.get("/qrcode", summary="Generate QR Code")
 async def generate_qrcode(
+    request: Request,
     data: str = Query(..., min_length=1, description="Data to encode in QR code"),
     size: int = Query(10, ge=1, le=40, description="Box size (pixels per module)"),
     border: int = Query(4, ge=1, description="Border size (in modules)"),
     fill_color: str = Query("black", description="QR code color"),
     back_color: str = Query("white", description="Background color"),
     version: int = Query(1, ge=1, le=40, description="QR code version (1-40)"),
-    error_correction: str = Query("L", description="Error correction level (L, M, Q, H)")
+    error_correction: str = Query("L", description="Error correction level (L, M, Q, H)"),
+    fmt: Literal["png", "svg"] = Query("svg", description="Image format (svg or png)")
 ):
     """
     Generate a QR code image from the provided data.
@@ -93,60 +207,96 @@ async def generate_qrcode(
     - back_color: Background color (name or hex value)
     - version: QR code version (1-40) that controls data capacity
     - error_correction: Error correction level (L=7%, M=15%, Q=25%, H=30%)
+    - fmt: Output format; svg skips rasterising entirely, png is kept for clients that need it
     """
-    try:
-        # Sanitize input filename
-        clean_data = sanitize_filename(data)
-        
-        # Map error correction string to constant
-        error_map = {
-            "L": qrcode.constants.ERROR_CORRECT_L,
-            "M": qrcode.constants.ERROR_CORRECT_M,
-            "Q": qrcode.constants.ERROR_CORRECT_Q,
-            "H": qrcode.constants.ERROR_CORRECT_H
-        }
-        
-        # Create QR code instance
-        qr = qrcode.QRCode(
-            version=version,
-            error_correction=error_map.get(error_correction.upper(), qrcode.constants.ERROR_CORRECT_L),
-            box_size=size,
-            border=border,
-        )
-        
-        # Add data and make QR code
-        qr.add_data(clean_data)
-        qr.make(fit=True)
-        
-        # Create image with specified colors
-        img = qr.make_image(fill_color=fill_color, back_color=back_color)
-        
-        # Save to bytes buffer
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-        
-        return StreamingResponse(
-            buffer,
-            media_type="image/png",
-            headers={"Content-Disposition": f"attachment; filename=qrcode_{clean_data}.png"}
+    return await qrcode_response(
+        request, data, size, border, fill_color, back_color, version, error_correction, fmt
+    )
+
+@app.post("/qrcode", summary="Generate QR Code from Request Body")
+async def generate_qrcode_from_body(
+    request: Request,
+    data: bytes = Body(..., media_type="text/plain", description="Data to encode in QR code"),
+    size: int = Query(10, ge=1, le=40, description="Box size (pixels per module)"),
+    border: int = Query(4, ge=1, description="Border size (in modules)"),
+    fill_color: str = Query("black", description="QR code color"),
+    back_color: str = Query("white", description="Background color"),
+    version: int = Query(1, ge=1, le=40, description="QR code version (1-40)"),
+    error_correction: str = Query("L", description="Error correction level (L, M, Q, H)"),
+    fmt: Literal["png", "svg"] = Query("svg", description="Image format (svg or png)")
+):
+    """
+    Generate a QR code image from the raw request body.
+    
+    Same as GET /qrcode, but the data is sent as a text/plain body instead of a query
+    parameter, which avoids URL encoding for large payloads.
+    """
+    return await qrcode_response(
+        request, data.decode("utf-8", "replace"), size, border, fill_color, back_color,
+        version, error_correction, fmt
+    )
+
+async def qrcode_response(request: Request, data: str, size: int, border: int, fill_color: str,
+                          back_color: str, version: int, error_correction: str, fmt: str) -> Response:
+    """Render data as a QR code image response shared by the /qrcode routes."""
+    if len(data.encode()) > MAX_QR_DATA:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Data too large for a QR code: at most {MAX_QR_DATA} bytes can be encoded"
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"QR generation failed: {str(e)}")
+    
+    # Sanitize input filename
+    clean_data = sanitize_filename(data)
+    
+    # Render with specified colors, reusing the bytes of identical requests
+    content, etag = await run_in_threadpool(
+        _render_qr, data, size, border, fill_color, back_color, version,
+        ERROR_MAP.get(error_correction.upper(), "L"), fmt
+    )
+    headers = {
+        "Content-Disposition": f'attachment; filename="qrcode_{clean_data}.{fmt}"',
+        "Cache-Control": "public, max-age=86400",
+        "ETag": etag
+    }
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return Response(
+        content=content,
+        media_type=MEDIA_TYPES[fmt],
+        headers=headers
+    )
+
+class VehicleIn(BaseModel):
+    """Vehicle fields accepted by the vehicle QR endpoints."""
+    brandid: str = Field(..., min_length=1, description="Brand ID")
+    vehiclename: str = Field(..., min_length=1, description="Vehicle name")
+    modelnumber: str = Field(..., min_length=1, description="Model number")
+    regnumber: str = Field(..., min_length=1, description="Registration number")
+    vehicletype: str = Field(..., min_length=1, description="Vehicle type")
+    vehiclesubtype: str = Field(..., min_length=1, description="Vehicle subtype")
+    varient: str = Field(..., min_length=1, description="Variant")
+    transmission: str = Field(..., min_length=1, description="Transmission type")
+    chasisnum: str = Field(..., min_length=1, description="Chassis number")
+    enginenumber: str = Field(..., min_length=1, description="Engine number")
+    description: Optional[str] = Field("", description="Vehicle description")
+
+async def render_vehicle_qr(vehicle_data: dict, size: int, border: int, fill_color: str,
+                            back_color: str, version: int, error_correction: str) -> tuple:
+    """Build the structured vehicle payload and render it, returning (png, qr data, timestamp)."""
+    generated_at = utc_timestamp()
+    qr_data = generate_vehicle_qr_data(vehicle_data, generated_at)
+    # The payload is unique per call, so skip the render cache
+    png = await run_in_threadpool(
+        build_qr_png, qr_data, size, border, fill_color, back_color, version,
+        ERROR_MAP.get(error_correction.upper(), "L")
+    )
+    return png, qr_data, generated_at
 
 @app.post("/qrcode/vehicle", summary="Generate Vehicle QR Code")
 async def generate_vehicle_qrcode(
-    brandid: str = Query(..., description="Brand ID"),
-    vehiclename: str = Query(..., description="Vehicle name"),
-    modelnumber: str = Query(..., description="Model number"),
-    regnumber: str = Query(..., description="Registration number"),
-    vehicletype: str = Query(..., description="Vehicle type"),
-    vehiclesubtype: str = Query(..., description="Vehicle subtype"),
-    varient: str = Query(..., description="Variant"),
-    transmission: str = Query(..., description="Transmission type"),
-    chasisnum: str = Query(..., description="Chassis number"),
-    enginenumber: str = Query(..., description="Engine number"),
-    description: Optional[str] = Query("", description="Vehicle description"),
+    vehicle: VehicleIn,
     size: int = Query(10, ge=1, le=40, description="Box size (pixels per module)"),
     border: int = Query(4, ge=1, description="Border size (in modules)"),
     fill_color: str = Query("black", description="QR code color"),
@@ -156,69 +306,112 @@ async def generate_vehicle_qrcode(
 ):
     """
     Generate a QR code for vehicle information with structured data.
-    Returns both the QR code image and the encoded data.
+    Returns the QR code image; the encoded data and generation time are sent in the
+    X-QR-Data and X-Generated-At headers. X-QR-Data is left out when the encoded payload
+    exceeds 4 KB; use /qrcode/vehicle/json to get the data in the body instead.
     """
-    try:
-        vehicle_data = {
-            'brandid': brandid,
-            'vehiclename': vehiclename,
-            'modelnumber': modelnumber,
-            'regnumber': regnumber,
-            'vehicletype': vehicletype,
-            'vehiclesubtype': vehiclesubtype,
-            'varient': varient,
-            'transmission': transmission,
-            'chasisnum': chasisnum,
-            'enginenumber': enginenumber,
-            'description': description
-        }
-        
-        if not validate_vehicle_data(vehicle_data):
-            raise HTTPException(status_code=400, detail="Missing required vehicle data fields")
-        
-        qr_data = generate_vehicle_qr_data(vehicle_data)
-        clean_data = sanitize_filename(f"{vehicle_data['vehiclename']}_{vehicle_data['regnumber']}")
-        
-        # Generate QR code
-        error_map = {
-            "L": qrcode.constants.ERROR_CORRECT_L,
-            "M": qrcode.constants.ERROR_CORRECT_M,
-            "Q": qrcode.constants.ERROR_CORRECT_Q,
-            "H": qrcode.constants.ERROR_CORRECT_H
-        }
-        
-        qr = qrcode.QRCode(
-            version=version,
-            error_correction=error_map.get(error_correction.upper(), qrcode.constants.ERROR_CORRECT_L),
-            box_size=size,
-            border=border,
-        )
-        
-        qr.add_data(qr_data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color=fill_color, back_color=back_color)
-        
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-        
-        return {
-            "qr_code": StreamingResponse(
-                buffer,
-                media_type="image/png",
-                headers={"Content-Disposition": f"attachment; filename=vehicle_qr_{clean_data}.png"}
-            ),
-            "qr_data": qr_data,
-            "vehicle_info": vehicle_data,
-            "metadata": {
-                "generated_at": datetime.utcnow().isoformat(),
-                "api_version": "2.0"
-            }
+    vehicle_data = vehicle.model_dump()
+    png, qr_data, generated_at = await render_vehicle_qr(
+        vehicle_data, size, border, fill_color, back_color, version, error_correction
+    )
+    clean_data = sanitize_filename(f"{vehicle_data['vehiclename']}_{vehicle_data['regnumber']}")
+    headers = {
+        "X-Generated-At": generated_at,
+        "Content-Disposition": f'attachment; filename="vehicle_qr_{clean_data}.png"'
+    }
+    
+    # Header values must be ASCII, so percent-encode anything outside the JSON syntax.
+    # Cap the encoded value rather than truncating the JSON, which would leave it invalid
+    # and still let non-ASCII text blow past proxy header buffers.
+    encoded_qr_data = quote(qr_data, safe='{}[]:,"')
+    if len(encoded_qr_data) <= MAX_QR_DATA_HEADER:
+        headers["X-QR-Data"] = encoded_qr_data
+    
+    return Response(content=png, media_type="image/png", headers=headers)
+
+@app.post("/qrcode/vehicle/json", summary="Generate Vehicle QR Code as JSON")
+async def generate_vehicle_qrcode_json(
+    vehicle: VehicleIn,
+    size: int = Query(10, ge=1, le=40, description="Box size (pixels per module)"),
+    border: int = Query(4, ge=1, description="Border size (in modules)"),
+    fill_color: str = Query("black", description="QR code color"),
+    back_color: str = Query("white", description="Background color"),
+    version: int = Query(1, ge=1, le=40, description="QR code version (1-40)"),
+    error_correction: str = Query("L", description="Error correction level (L, M, Q, H)")
+):
+    """
+    Generate a QR code for vehicle information with structured data.
+    Returns the base64-encoded PNG together with the encoded data and vehicle info.
+    """
+    vehicle_data = vehicle.model_dump()
+    png, qr_data, generated_at = await render_vehicle_qr(
+        vehicle_data, size, border, fill_color, back_color, version, error_correction
+    )
+    
+    return {
+        "png_b64": base64.b64encode(png).decode(),
+        "qr_data": qr_data,
+        "vehicle_info": vehicle_data,
+        "metadata": {
+            "generated_at": generated_at,
+            "api_version": "2.0"
         }
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Vehicle QR generation failed: {str(e)}")
+    }
+
+@render_cache()
+def _render_barcode(data: str, fmt: str) -> tuple:
+    """Render data as a Code 128 barcode in fmt, returning (bytes, ETag) for repeated requests."""
+    buffer = io.BytesIO()
+    if fmt == "svg":
+        CODE128(data, writer=SVGWriter()).write(buffer)
+    else:
+        img = CODE128(data, writer=ImageWriter()).render()
+        img.save(buffer, format="PNG", compress_level=1, optimize=False)
+    content = buffer.getvalue()
+    return content, f'"{hashlib.sha1(content).hexdigest()}"'
+
+@app.get("/barcode", summary="Generate Barcode")
+async def generate_barcode(
+    request: Request,
+    data: str = Query(..., min_length=1, max_length=MAX_BARCODE_DATA,
+                      description="ID to encode as a Code 128 barcode"),
+    fmt: Literal["png", "svg"] = Query("svg", description="Image format (svg or png)")
+):
+    """
+    Generate a Code 128 barcode image from the provided ID.
+    
+    Parameters:
+    - data: The ID to encode (at most 80 characters); Code 128 supports ASCII characters only
+    - fmt: Output format; svg skips rasterising entirely, png is kept for clients that need it
+    """
+    clean_id = sanitize_filename(data)
+    
+    content, etag = await run_in_threadpool(_render_barcode, data, fmt)
+    headers = {
+        "Content-Disposition": f'attachment; filename="barcode_{clean_id}.{fmt}"',
+        "Cache-Control": "public, max-age=86400",
+        "ETag": etag
+    }
+    
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    
+    return Response(
+        content=content,
+        media_type=MEDIA_TYPES[fmt],
+        headers=headers
+    )
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers need an import string; loop="auto" uses uvloop whenever it is installed
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count(),
+        loop="auto",
+        http="httptools",
+        access_log=False
+    )